@@ -1,16 +1,47 @@
 import os
+import sys
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import json
 import logging
+from collections import OrderedDict
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, Boolean, select, bindparam
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
-from contextlib import contextmanager
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from contextlib import contextmanager, asynccontextmanager
 import re
-from langchain.text_splitter import CharacterTextSplitter
+import shutil
+import tempfile
+import numpy as np
+import torch
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.chains import RetrievalQA
+from langchain_core.embeddings import Embeddings
+
+# uvloop is optional and unavailable on Windows; without it the stdlib event loop is used
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# ONNX Runtime is optional; without it embeddings run through sentence-transformers
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    onnxruntime = None
 
 # Load environment variables
 load_dotenv()
@@ -20,19 +51,71 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Get API key from environment variable
-GROQ_API_KEY = os.environ["GROQ_API_KEY"] = "Enter YOUR API KEY"
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 if not GROQ_API_KEY:
     raise ValueError("GROQ_API_KEY environment variable is not set")
 
-# Initialize the ChatGroq model
-chat = ChatGroq(temperature=0, model_name="mixtral-8x7b-32768")
+@functools.lru_cache(maxsize=None)
+def get_http_async_client():
+    """Shared HTTP client for Groq requests; multiplexes them over HTTP/2 when h2 is installed."""
+    import httpx
+    return httpx.AsyncClient(http2=True) if importlib.util.find_spec("h2") else None
+
+def create_groq_chat(**kwargs):
+    from langchain_groq import ChatGroq
+    return ChatGroq(temperature=0, api_key=GROQ_API_KEY, http_async_client=get_http_async_client(), **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def get_chat():
+    """Create the ChatGroq model on first use, inside the running event loop."""
+    return create_groq_chat(model_name="mixtral-8x7b-32768")
+
+@functools.lru_cache(maxsize=None)
+def get_classifier_chat():
+    """Small, fast model used only to pick an email category, answering in JSON mode."""
+    return create_groq_chat(
+        model_name="llama-3.1-8b-instant",
+        max_tokens=8,
+        model_kwargs={"response_format": {"type": "json_object"}},
+    )
+
+# Maximum number of emails processed concurrently; keep within the Groq rate limit
+CONCURRENCY_LIMIT = int(os.environ.get("GROQ_CONCURRENCY_LIMIT", "4"))
 
 Base = declarative_base()
 
-# Database setup
-engine = create_engine('sqlite:///film_equipment_rental.db')
+# Database setup; each engine keeps a single pooled connection that its sessions reuse
+engine = create_engine(
+    'sqlite:///film_equipment_rental.db',
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
 Session = sessionmaker(bind=engine)
 
+# Async engine used by the email handlers; one session is shared by a whole batch
+async_engine = create_async_engine(
+    'sqlite+aiosqlite:///film_equipment_rental.db',
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+# WAL lets readers proceed while a write is in progress, and NORMAL sync skips the fsync on every commit
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+event.listen(engine, "connect", configure_sqlite_connection)
+event.listen(async_engine.sync_engine, "connect", configure_sqlite_connection)
+
+async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+current_session = ContextVar("current_session", default=None)
+# An AsyncSession must not run concurrent operations, so concurrent handlers take turns on this lock.
+# It is created with the session inside the running loop; on Python < 3.10 a lock binds to the loop current at creation
+current_session_lock = ContextVar("current_session_lock", default=None)
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
@@ -47,17 +130,40 @@ def session_scope():
     finally:
         session.close()
 
+@asynccontextmanager
+async def batch_session_scope():
+    """Open one async session and make it the current session for every handler run inside the scope."""
+    async with async_session_factory() as session:
+        token = current_session.set(session)
+        lock_token = current_session_lock.set(asyncio.Lock())
+        try:
+            yield session
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Database error: {e}")
+            raise
+        finally:
+            current_session_lock.reset(lock_token)
+            current_session.reset(token)
+
 class Equipment(Base):
     __tablename__ = 'equipment'
     
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, unique=True, index=True)
     category = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     available = Column(Boolean, default=True)
 
 # Create the database schema if it doesn't exist
 Base.metadata.create_all(engine)
+# create_all skips tables that already exist, so add indexes to databases created before they were declared
+for index in Equipment.__table__.indexes:
+    index.create(engine, checkfirst=True)
+
+# Equipment lookup by name, built once and reused for every inquiry
+equipment_by_name_query = select(Equipment).where(Equipment.name == bindparam("name"))
 
 # FAQ document
 faq_document = """
@@ -92,37 +198,265 @@ Q: What's the maximum output of the ARRI SkyPanel S60-C?
 A: The ARRI SkyPanel S60-C has a maximum output of 1268 lux at 3 meters (9.8 feet) when set to 5600K (daylight).
 """
 
+# Directory where FAQ vector stores are persisted, one subdirectory per FAQ version
+CHROMA_PERSIST_DIR = "./chroma_faq"
+
+# HNSW index parameters for the FAQ collection (Chroma defaults: M=16, construction_ef=100, search_ef=10)
+FAQ_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
+
+# FAQ chunking; 512 characters stays within the sentence-transformer's input window
+FAQ_CHUNK_SIZE = 512
+FAQ_CHUNK_OVERLAP = 64
+
+# Embed chunks in batches rather than one at a time
+EMBEDDING_ENCODE_KWARGS = {"batch_size": 64, "normalize_embeddings": True}
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Directory holding the int8-quantized ONNX export of the embedding model
+ONNX_MODEL_DIR = "./onnx_models/all-MiniLM-L6-v2-int8"
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence-transformer embeddings served by ONNX Runtime from a dynamically int8-quantized export."""
+
+    # Files a finished export leaves in model_dir
+    EXPORT_FILES = ("model_quantized.onnx", "config.json", "tokenizer_config.json")
+
+    def __init__(self, model_name, model_dir, batch_size=64):
+        if not all(os.path.isfile(os.path.join(model_dir, f)) for f in self.EXPORT_FILES):
+            self._export(model_name, model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name="model_quantized.onnx")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _export(model_name, model_dir):
+        logger.info(f"Exporting {model_name} to int8 ONNX in {model_dir}")
+        # Export into a scratch directory and move it into place only once every file is written,
+        # so a failed export never leaves a model_dir that looks usable
+        parent_dir = os.path.dirname(os.path.abspath(model_dir))
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+        try:
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=tmp_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+            )
+            model.config.save_pretrained(tmp_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+            # Clear out what an earlier interrupted export may have left behind
+            shutil.rmtree(model_dir, ignore_errors=True)
+            os.replace(tmp_dir, model_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True, return_tensors="np")
+            hidden = self.model(**inputs).last_hidden_state
+            # Mean-pool over real tokens and normalize, matching sentence-transformers
+            mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_documents(self, texts):
+        return self._embed(list(texts))
+
+    def embed_query(self, text):
+        return self._embed([text])[0]
+
+def create_embeddings():
+    # Dynamic int8 kernels target CPUs, so a GPU keeps running the torch model
+    if torch.cuda.is_available():
+        return "torch-cuda", HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL_NAME,
+            model_kwargs={"device": "cuda"},
+            encode_kwargs=EMBEDDING_ENCODE_KWARGS,
+        )
+    if onnxruntime is not None:
+        return "onnx-int8", OnnxEmbeddings(EMBEDDING_MODEL_NAME, ONNX_MODEL_DIR, batch_size=EMBEDDING_ENCODE_KWARGS["batch_size"])
+    return "torch-cpu", HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs=EMBEDDING_ENCODE_KWARGS,
+    )
+
+# Load the embedding model once and share it between indexing and queries
+embedding_backend, embeddings = create_embeddings()
+logger.info(f"Using {embedding_backend} embeddings")
+
 # Create vector store for FAQ
 def create_vector_store(faq_document):
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    # Key the persisted index on the FAQ contents and index settings so edits trigger a rebuild
+    index_settings = (
+        sorted(FAQ_COLLECTION_METADATA.items()),
+        embedding_backend,
+        sorted(EMBEDDING_ENCODE_KWARGS.items()),
+        FAQ_CHUNK_SIZE,
+        FAQ_CHUNK_OVERLAP,
+    )
+    faq_hash = hashlib.sha256((faq_document + repr(index_settings)).encode()).hexdigest()
+    persist_directory = os.path.join(CHROMA_PERSIST_DIR, faq_hash)
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=FAQ_CHUNK_SIZE, chunk_overlap=FAQ_CHUNK_OVERLAP)
     texts = text_splitter.split_text(faq_document)
-    embeddings = HuggingFaceEmbeddings()
-    vectorstore = Chroma.from_texts(texts, embeddings)
+    vectorstore = Chroma(
+        persist_directory=persist_directory,
+        embedding_function=embeddings,
+        collection_metadata=FAQ_COLLECTION_METADATA,
+    )
+
+    # Chroma creates the directory before anything is embedded, so an interrupted build can leave
+    # an empty or partial collection behind; only reuse it when every chunk is present
+    existing_ids = vectorstore.get(include=[])["ids"]
+    if len(existing_ids) == len(texts):
+        logger.info(f"Loaded persisted FAQ vector store from {persist_directory}")
+        return vectorstore
+    if existing_ids:
+        logger.warning(f"Rebuilding incomplete FAQ vector store in {persist_directory}")
+        vectorstore.delete(ids=existing_ids)
+
+    vectorstore.add_texts(texts)
+    logger.info(f"Persisted FAQ vector store to {persist_directory}")
     return vectorstore
 
 vectorstore = create_vector_store(faq_document)
 
-def classify_email(email_content):
-    try:
-        classification_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are an AI assistant that classifies emails into four categories: 'positive_review', 'negative_review', 'price_availability_inquiry', or 'general_inquiry'. Respond with ONLY the category name, nothing else."),
-            ("human", f"""
-    Classify the following email into one of these categories: 'positive_review', 'negative_review', 'price_availability_inquiry', or 'general_inquiry':
+def warm_up_vector_store():
+    """Run throwaway embeddings and a search so model loading and index setup happen before the first email."""
+    # The batched path is separate from single queries in the ONNX model, so exercise both
+    embeddings.embed_documents(["warmup"] * 2)
+    vectorstore.similarity_search("warmup", k=1)
+
+warm_up_vector_store()
+
+def normalize_query(text):
+    # all-MiniLM-L6-v2 is uncased, so lowercasing does not change the embedding
+    return re.sub(r"\s+", " ", text.lower().strip())
+
+# Number of FAQ chunks placed in the prompt for a general inquiry
+FAQ_RETRIEVAL_K = 3
+
+@functools.lru_cache(maxsize=512)
+def _retrieve(query_norm):
+    """Return the FAQ chunks matching a normalized query, skipping embedding and search on repeats."""
+    return tuple(doc.page_content for doc in vectorstore.similarity_search(query_norm, k=FAQ_RETRIEVAL_K))
+
+class EmailTriage(BaseModel):
+    """Structured result of classifying an email and drafting its reply in one call."""
+    category: Literal["positive_review", "negative_review", "price_availability_inquiry", "general_inquiry"]
+    equipment_name: Optional[str] = Field(None, description="Film equipment the email asks about, for price_availability_inquiry")
+    draft_response: Optional[str] = Field(None, description="Reply to send, for positive_review and negative_review")
+
+# Prompts are built once at import; their chains are built on first use so the Groq client is created lazily
+triage_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are an AI assistant for a film equipment rental service. Classify the email into one of four categories: 'positive_review', 'negative_review', 'price_availability_inquiry', or 'general_inquiry'.\n"
+               "- For 'positive_review', set draft_response to a reply that thanks the customer and encourages them to share their experience on social media.\n"
+               "- For 'negative_review', set draft_response to a reply that apologizes for the inconvenience, offers a solution, mentions that a customer service representative will call them, and offers a gift voucher for their next rental.\n"
+               "- For 'price_availability_inquiry', set equipment_name to the name of the film equipment mentioned.\n"
+               "- For 'general_inquiry', leave equipment_name and draft_response empty."),
+    ("human", "Email:\n\n{email_content}")
+])
+@functools.lru_cache(maxsize=None)
+def get_triage_chain():
+    return triage_prompt | get_chat().with_structured_output(EmailTriage)
+
+# Single-letter category codes returned by the classifier, so its answer decodes in a few tokens
+CATEGORY_CODES = {
+    "p": "positive_review",
+    "n": "negative_review",
+    "a": "price_availability_inquiry",
+    "g": "general_inquiry",
+}
+
+classification_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are an AI assistant that classifies emails into four categories: 'p' (positive review), 'n' (negative review), 'a' (price or availability inquiry), or 'g' (general inquiry). Respond with ONLY a JSON object of the form {{\"c\": \"<code>\"}}, nothing else."),
+    ("human", """
+    Classify the following email:
 
     {email_content}
 
-    Classification:""")
-        ])
-        
-        chain = classification_prompt | chat
-        response = chain.invoke({"email_content": email_content})
-        raw_classification = response.content.strip().lower()
+    JSON:""")
+])
+@functools.lru_cache(maxsize=None)
+def get_classify_chain():
+    return classification_prompt | get_classifier_chat()
+
+extraction_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are an AI assistant that extracts equipment names from emails."),
+    ("human", "Extract the name of the film equipment mentioned in the following email:\n\n{email_content}\n\nEquipment name:")
+])
+@functools.lru_cache(maxsize=None)
+def get_extract_chain():
+    return extraction_prompt | get_chat()
+
+positive_review_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are responding to a positive review about a film equipment rental service. Thank the customer and encourage them to share their experience on social media."),
+    ("human", "Positive review: {review}\n\nResponse:")
+])
+@functools.lru_cache(maxsize=None)
+def get_positive_chain():
+    return positive_review_prompt | get_chat()
+
+negative_review_prompt = ChatPromptTemplate.from_template(
+    "You are responding to a negative review about a film equipment rental service. "
+    "Apologize for the inconvenience, offer a solution, and mention that a customer service "
+    "representative will call them. Also, offer a gift voucher for their next rental. "
+    "Review: {review}"
+)
+@functools.lru_cache(maxsize=None)
+def get_negative_chain():
+    return negative_review_prompt | get_chat()
+
+general_inquiry_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are answering a customer email for a film equipment rental service. Answer using only the FAQ context below. If the context does not contain the answer, say you don't know and suggest contacting customer service.\n\nFAQ context:\n{context}"),
+    ("human", "{question}")
+])
+@functools.lru_cache(maxsize=None)
+def get_general_chain():
+    return general_inquiry_prompt | get_chat()
+
+# Category labels accepted from the classifier, matched case-insensitively
+_CAT_RE = re.compile(r"positive_review|negative_review|price_availability_inquiry|general_inquiry", re.IGNORECASE)
+
+async def triage_email(email_content):
+    """Classify the email and draft its reply or extract its equipment name in a single LLM call."""
+    try:
+        triage = await get_triage_chain().ainvoke({"email_content": email_content})
+        logger.info(f"Triage result: {triage}")
+        return triage
+    except Exception as e:
+        logger.error(f"Error triaging email: {e}")
+        return None
+
+async def classify_email(email_content):
+    try:
+        response = await get_classify_chain().ainvoke({"email_content": email_content})
+        raw_classification = response.content
         logger.info(f"Raw classification response: {raw_classification}")
+
+        try:
+            code = json.loads(raw_classification).get("c")
+        except (ValueError, AttributeError):
+            code = None
+        if code in CATEGORY_CODES:
+            logger.info(f"Extracted classification: {CATEGORY_CODES[code]}")
+            return CATEGORY_CODES[code]
         
-        # Extract the category using regex
-        match = re.search(r'(positive_review|negative_review|price_availability_inquiry|general_inquiry)', raw_classification)
+        # Fall back to finding a full category name in the response
+        match = _CAT_RE.search(raw_classification)
         if match:
-            classified_category = match.group(1)
+            classified_category = match.group(0).lower()
             logger.info(f"Extracted classification: {classified_category}")
             return classified_category
         else:
@@ -132,97 +466,191 @@ def classify_email(email_content):
         logger.error(f"Error classifying email: {str(e)}")
         return "error"
 
-def extract_equipment_name(email_content):
+async def extract_equipment_name(email_content):
     try:
-        extraction_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are an AI assistant that extracts equipment names from emails."),
-            ("human", "Extract the name of the film equipment mentioned in the following email:\n\n{email_content}\n\nEquipment name:")
-        ])
-        
-        chain = extraction_prompt | chat
-        response = chain.invoke({"email_content": email_content})
+        response = await get_extract_chain().ainvoke({"email_content": email_content})
         return response.content.strip()
     except Exception as e:
         logger.error(f"Error extracting equipment name: {e}")
         return None
 
-def handle_price_availability_inquiry(email_content):
-    equipment_name = extract_equipment_name(email_content)
-    if equipment_name:
-        with session_scope() as session:
-            equipment = session.query(Equipment).filter_by(name=equipment_name).first()
-            
-            if equipment:
-                availability = "available" if equipment.available else "not available"
-                return f"The {equipment.name} is {availability} for rent at ${equipment.price} per day."
-            else:
-                return f"We're sorry, but we don't have information about {equipment_name} in our database. Please contact our customer service for more details."
-    
-    return "Thank you for your inquiry. We couldn't find specific information about the equipment you mentioned. Please contact our customer service for further assistance."
+# LRU cache of equipment lookups, cleared when inventory changes
+EQUIPMENT_CACHE_SIZE = 1024
+_equipment_cache = OrderedDict()
 
-def handle_general_inquiry(email_content):
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=chat,
-        chain_type="stuff",
-        retriever=vectorstore.as_retriever()
-    )
-    response = qa_chain.run(email_content)
-    return response
-
-def handle_positive_review(email_content):
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are responding to a positive review about a film equipment rental service. Thank the customer and encourage them to share their experience on social media."),
-        ("human", "Positive review: {review}\n\nResponse:")
-    ])
-    
-    chain = prompt | chat
-    response = chain.invoke({"review": email_content})
-    return response.content.strip()
+async def _query_equipment(session, lock, equipment_name):
+    async with lock:
+        result = await session.execute(equipment_by_name_query, {"name": equipment_name})
+    return result.scalars().first()
+
+async def _lookup_equipment(equipment_name):
+    """Return (name, price, available) for the named equipment, or None."""
+    if equipment_name in _equipment_cache:
+        _equipment_cache.move_to_end(equipment_name)
+        return _equipment_cache[equipment_name]
+
+    session = current_session.get()
+    if session is not None:
+        equipment = await _query_equipment(session, current_session_lock.get(), equipment_name)
+    else:
+        # A session of our own is not shared, so its lock is never contended
+        async with async_session_factory() as session:
+            equipment = await _query_equipment(session, asyncio.Lock(), equipment_name)
+
+    result = (equipment.name, equipment.price, equipment.available) if equipment else None
+    _equipment_cache[equipment_name] = result
+    if len(_equipment_cache) > EQUIPMENT_CACHE_SIZE:
+        _equipment_cache.popitem(last=False)
+    return result
+
+# Known equipment names for local matching, refreshed when inventory changes
+equipment_names = []
+
+def refresh_equipment_names():
+    with session_scope() as session:
+        equipment_names[:] = session.execute(select(Equipment.name)).scalars().all()
+
+def _name_tokens(text):
+    # Lowercase alphanumeric runs, so "S60-C?" and "s60 c" give the same tokens
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+def match_equipment_name(text):
+    """Return the known equipment name whose every token, model number included, appears in text, or None."""
+    text_tokens = _name_tokens(text)
+    matches = [name for name in equipment_names if _name_tokens(name) <= text_tokens]
+    # Prefer the most specific name when several are contained in the text
+    return max(matches, key=lambda name: len(_name_tokens(name)), default=None)
+
+def resolve_equipment_name(equipment_name):
+    """Map an extracted name to the known name it equals, ignoring case, or None; never to a different model."""
+    if equipment_name in equipment_names:
+        return equipment_name
+    folded = equipment_name.casefold()
+    return next((name for name in equipment_names if name.casefold() == folded), None)
+
+async def handle_price_availability_inquiry(email_content, equipment_name=None, on_token=None):
+    matched_name = resolve_equipment_name(equipment_name) if equipment_name else None
+    if matched_name is None:
+        # Find a known name in the email locally before falling back to the LLM's extraction
+        matched_name = match_equipment_name(email_content)
+    if matched_name is None and not equipment_name:
+        equipment_name = await extract_equipment_name(email_content)
+        matched_name = resolve_equipment_name(equipment_name) if equipment_name else None
+
+    # equipment_names holds every name in the database, so an unresolved name cannot match a row
+    if matched_name is None:
+        if equipment_name:
+            return f"We're sorry, but we don't have information about {equipment_name} in our database. Please contact our customer service for more details."
+        return "Thank you for your inquiry. We couldn't find specific information about the equipment you mentioned. Please contact our customer service for further assistance."
+
+    equipment = await _lookup_equipment(matched_name)
+    if equipment:
+        name, price, available = equipment
+        availability = "available" if available else "not available"
+        return f"The {name} is {availability} for rent at ${price} per day."
+    return f"We're sorry, but we don't have information about {matched_name} in our database. Please contact our customer service for more details."
+
+async def generate_response(chain, inputs, on_token=None):
+    """Run a prompt chain, passing each chunk to on_token as it streams in when a callback is given."""
+    if on_token is None:
+        response = await chain.ainvoke(inputs)
+        return response.content
+    pieces = []
+    async for chunk in chain.astream(inputs):
+        on_token(chunk.content)
+        pieces.append(chunk.content)
+    return "".join(pieces)
+
+async def handle_positive_review(email_content, equipment_name=None, on_token=None):
+    response = await generate_response(get_positive_chain(), {"review": email_content}, on_token)
+    return response.strip()
+
+async def handle_negative_review(email_content, equipment_name=None, on_token=None):
+    return await generate_response(get_negative_chain(), {"review": email_content}, on_token)
+
+async def handle_general_inquiry(email_content, equipment_name=None, on_token=None):
+    # Embedding the query is CPU-bound, so keep it off the event loop
+    chunks = await asyncio.to_thread(_retrieve, normalize_query(email_content))
+    context = "\n\n".join(chunks)
+    return await generate_response(get_general_chain(), {"context": context, "question": email_content}, on_token)
+
+# Handler for each email category; all handlers take (email_content, equipment_name, on_token)
+DISPATCH = {
+    "positive_review": handle_positive_review,
+    "negative_review": handle_negative_review,
+    "price_availability_inquiry": handle_price_availability_inquiry,
+    "general_inquiry": handle_general_inquiry,
+}
+
+async def handle_email(email_content, on_token=None):
+    """Return (category, response); generated replies are streamed to on_token when it is given."""
+    streamed = False
+
+    def emit(piece):
+        nonlocal streamed
+        streamed = True
+        on_token(piece)
 
-def handle_email(email_content):
     try:
-        category = classify_email(email_content)
-        
-        if category == "positive_review":
-            return category, handle_positive_review(email_content)
-        elif category == "negative_review":
-            prompt = ChatPromptTemplate.from_template(
-                "You are responding to a negative review about a film equipment rental service. "
-                "Apologize for the inconvenience, offer a solution, and mention that a customer service "
-                "representative will call them. Also, offer a gift voucher for their next rental. "
-                "Review: {review}"
-            )
-            chain = prompt | chat
-            response = chain.invoke({"review": email_content})
-            return category, response.content
-        elif category == "price_availability_inquiry":
-            return category, handle_price_availability_inquiry(email_content)
-        elif category == "general_inquiry":
-            return category, handle_general_inquiry(email_content)
+        triage = await triage_email(email_content)
+        if triage is not None:
+            category, equipment_name, draft_response = triage.category, triage.equipment_name, triage.draft_response
         else:
-            return "forward_to_customer_service", "This email requires further evaluation and has been forwarded to our customer service team. They will contact you shortly."
+            # Fall back to a separate classification call if the structured response failed
+            category = await classify_email(email_content)
+            equipment_name = draft_response = None
+
+        handler = DISPATCH.get(category)
+        if category in ("positive_review", "negative_review") and draft_response:
+            response = draft_response.strip()
+        elif handler is not None:
+            response = await handler(email_content, equipment_name, emit if on_token is not None else None)
+        else:
+            category, response = "forward_to_customer_service", "This email requires further evaluation and has been forwarded to our customer service team. They will contact you shortly."
     except Exception as e:
         logger.error(f"Error handling email: {e}")
-        return "error", "We encountered an error processing your email. A customer service representative will contact you shortly."
+        category, response = "error", "We encountered an error processing your email. A customer service representative will contact you shortly."
+        # A stream that failed partway still has to show the error reply, set apart from the cut-off text
+        if streamed:
+            on_token("\n\n")
+            streamed = False
+
+    # Replies that were not generated token by token are delivered to the stream in one piece
+    if on_token is not None and not streamed:
+        on_token(response)
+    return category, response
+
+SAMPLE_EQUIPMENT = [
+    dict(name="RED DSMC 2", category="Cameras", price=850.00, available=True),
+    dict(name="Canon EF 24-70mm", category="Lenses", price=50.00, available=True),
+    dict(name="DJI Ronin-S", category="Stabilizers", price=75.00, available=False),
+    dict(name="ARRI SkyPanel S60-C", category="Lighting", price=200.00, available=True),
+]
+
+# INSERT OR IGNORE with bound parameters, run as a single executemany over the rows
+insert_equipment_stmt = sqlite_insert(Equipment).on_conflict_do_nothing(index_elements=["name"])
 
 def add_sample_data():
-    sample_equipment = [
-        Equipment(name="RED DSMC 2", category="Cameras", price=850.00, available=True),
-        Equipment(name="Canon EF 24-70mm", category="Lenses", price=50.00, available=True),
-        Equipment(name="DJI Ronin-S", category="Stabilizers", price=75.00, available=False),
-        Equipment(name="ARRI SkyPanel S60-C", category="Lighting", price=200.00, available=True),
-    ]
-    
     with session_scope() as session:
-        for equipment in sample_equipment:
-            existing = session.query(Equipment).filter_by(name=equipment.name).first()
-            if not existing:
-                session.add(equipment)
+        session.execute(insert_equipment_stmt, SAMPLE_EQUIPMENT)
+    _equipment_cache.clear()
+    refresh_equipment_names()
+
+async def stream_reply(email_content):
+    """Print the reply to a single email as it is generated."""
+    category, _ = await handle_email(email_content, on_token=lambda piece: print(piece, end="", flush=True))
+    print()
+    logger.info(f"Category: {category}")
 
-def main():
+async def main():
     # Add sample data to the database
     add_sample_data()
 
+    # Reply to an email given on the command line, streaming the response
+    if len(sys.argv) > 1:
+        await stream_reply(" ".join(sys.argv[1:]))
+        return
+
     # Example usage
     email_samples = [
         "What is the price of ARRI SkyPanel S60-C?",
@@ -235,11 +663,35 @@ def main():
         "Is the Canon EF 24-70mm lens available for rent?",
     ]
 
-    for email in email_samples:
-        category, response = handle_email(email)
+    # Process all emails concurrently, bounded by the Groq rate limit
+    semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+
+    async def bounded_handle_email(email):
+        async with semaphore:
+            return await handle_email(email)
+
+    # Share one database session across the whole batch
+    async with batch_session_scope():
+        results = await asyncio.gather(*(bounded_handle_email(email) for email in email_samples))
+
+    for email, (category, response) in zip(email_samples, results):
         logger.info(f"Email: {email}")
         logger.info(f"Category: {category}")
         logger.info(f"Response: {response}\n")
 
+async def run():
+    try:
+        await main()
+    finally:
+        await async_engine.dispose()
+        # Close the Groq HTTP client only if one was created; calling the getter would otherwise create it
+        if get_http_async_client.cache_info().currsize:
+            http_async_client = get_http_async_client()
+            if http_async_client is not None:
+                await http_async_client.aclose()
+
 if __name__ == "__main__":
-    main()
+    if uvloop is not None:
+        uvloop.run(run())
+    else:
+        asyncio.run(run())